@@ -46,9 +46,27 @@ class ColoredCurveCollection(object):
         self.curves_per_length[length].append((curve, value))
         self.prepared = False
 
-    def add_curves(self, curves, values):
-        for c, v in zip(curves, values):
-            self.add_curve(c, v)
+    def add_curves(self, curves, values=1.0):
+        if len(curves) == 0:
+            return
+
+        if np.isscalar(values):
+            values = repeat(values)
+
+        if isinstance(curves, np.ndarray) and curves.dtype != object:
+            # all curves share the same length: store them in a single pass
+            self.curves_per_length[curves.shape[1]].extend(zip(curves, values))
+        else:
+            for c, v in zip(curves, values):
+                self.curves_per_length[c.shape[0]].append((c, v))
+
+        self.prepared = False
+
+    @classmethod
+    def from_curves(cls, curves, values=1.0, **kwargs):
+        collection = cls(**kwargs)
+        collection.add_curves(curves, values)
+        return collection
 
     def set_colors(self, source=None, target=None):
         if source is not None:
@@ -1,10 +1,11 @@
 from collections import defaultdict
 
+import matplotlib.colors as colors
 import numpy as np
 import pandas as pd
 import seaborn as sns
-from cytoolz import unique
 from matplotlib.collections import LineCollection
+from numba import njit, prange
 
 from aves.models.network import Network
 from aves.visualization.collections import ColoredCurveCollection
@@ -13,6 +14,98 @@ from aves.visualization.colors.palettes import build_palette
 
 from .bezier_edges import curved_edges
 
+# cantidad de aristas desde la cual se rasterizan por omisión
+_RASTERIZE_MIN_EDGES = 5000
+
+
+def _stack_points(points_list, dtype=np.float64):
+    """
+    Apila las coordenadas de las aristas en un único arreglo.
+
+    Si todas las aristas tienen la misma cantidad de puntos, se construye un arreglo de forma
+    `(n_aristas, n_puntos, 2)` en una sola llamada a NumPy. En caso contrario se retorna una lista
+    de arreglos (LineCollection acepta listas), para evitar un arreglo de objetos. Si `points_list` ya es
+    un arreglo, solo se convierte al tipo `dtype`.
+    """
+    if isinstance(points_list, np.ndarray):
+        return points_list.astype(dtype, copy=False)
+
+    if not points_list:
+        return np.empty((0, 2, 2), dtype=dtype)
+
+    try:
+        return np.asarray(points_list, dtype=dtype)
+    except ValueError:
+        # las aristas tienen distinta cantidad de puntos
+        return [np.asarray(points, dtype=dtype) for points in points_list]
+
+
+def _take_lines(lines, indices):
+    """
+    Selecciona las aristas indicadas por `indices`, tanto si `lines` es un arreglo como si es una lista de arreglos.
+    """
+    if isinstance(lines, np.ndarray):
+        return lines[indices]
+
+    return [lines[i] for i in indices]
+
+
+def _is_straight_edge(points):
+    """
+    Indica si una arista es un segmento recto, es decir, si solo está definida por sus dos extremos.
+    """
+    return isinstance(points, (list, np.ndarray)) and len(points) == 2
+
+
+@njit(cache=True)
+def _community_pair_kernel(src, tgt, community_codes, n_communities):
+    """
+    Calcula un identificador por arista para el par (comunidad de origen, comunidad de destino).
+
+    El identificador es `codigo_origen * n_comunidades + codigo_destino`, donde los códigos son
+    las posiciones de cada comunidad en la lista ordenada de comunidades.
+    """
+    out = np.empty(src.shape[0], dtype=np.int64)
+    for i in range(src.shape[0]):
+        out[i] = (
+            community_codes[src[i]] * n_communities + community_codes[tgt[i]]
+        )
+    return out
+
+
+def _equal_width_bins(weights, k):
+    """
+    Divide los pesos en `k` grupos de igual ancho, con los mismos límites e intervalos cerrados por la derecha
+    que `pd.cut(weights, k)`, pero sin construir objetos de pandas.
+
+    Si los pesos contienen valores no finitos o son todos iguales se delega en `pd.cut`.
+    """
+    lo, hi = np.min(weights), np.max(weights)
+    if not (np.isfinite(lo) and np.isfinite(hi) and lo < hi):
+        return pd.cut(weights, k, labels=False, retbins=True, duplicates="raise")
+
+    bins = np.linspace(lo, hi, k + 1)
+    # al igual que pandas, se extiende el límite inferior para incluir el mínimo
+    bins[0] -= (hi - lo) * 0.001
+    groups = np.searchsorted(bins[1:-1], weights, side="left")
+
+    return groups, bins
+
+
+@njit(parallel=True, cache=True)
+def _od_interp_kernel(src, tgt, interp, out):
+    """
+    Interpola linealmente cada arista entre su origen `src[i]` y su destino `tgt[i]` en las posiciones `interp`,
+    y escribe el resultado en `out`, de forma `(n_aristas, n_puntos, 2)`. Las aristas son independientes entre sí,
+    por lo que se reparten entre los núcleos disponibles.
+    """
+    for i in prange(src.shape[0]):
+        for j in range(interp.shape[0]):
+            t = interp[j]
+            out[i, j, 0] = src[i, 0] * (1 - t) + tgt[i, 0] * t
+            out[i, j, 1] = src[i, 1] * (1 - t) + tgt[i, 1] * t
+    return out
+
 
 class EdgeStrategy(RenderStrategy):
     """Una interfaz para los métodos de visualziación de aristas."""
@@ -31,6 +124,7 @@ class EdgeStrategy(RenderStrategy):
         """
         self.network = network
         self.curved_lines = kwargs.get("curved", False)
+        self._artist = None
         super().__init__(self.network.edge_data)
 
     def name(self):
@@ -45,17 +139,36 @@ class EdgeStrategy(RenderStrategy):
         """
         return "strategy-name"
 
+    def _rasterize(self, rasterized, n_edges):
+        """
+        Determina si las aristas deben rasterizarse. Si `rasterized` es None, se rasterizan las redes
+        con más de `_RASTERIZE_MIN_EDGES` aristas, para las cuales el trazado vectorial es muy costoso.
+        """
+        if rasterized is None:
+            return n_edges > _RASTERIZE_MIN_EDGES
+        return rasterized
+
+    def _draw_lines(self, ax, segments, update=False, **kwargs):
+        """
+        Agrega `segments` a `ax` como una LineCollection nueva. Si `update` es True y la última colección dibujada
+        por la estrategia sigue en `ax`, se quita de los ejes antes de agregar la nueva, para no acumular
+        colecciones al redibujar. La colección nueva siempre se construye con las propiedades de la llamada actual.
+        """
+        collection = LineCollection(segments, **kwargs)
+
+        if update and self._artist is not None and self._artist.axes is ax:
+            self._artist.remove()
+
+        self._artist = ax.add_collection(collection)
+        return self._artist
+
     def build_lines(self, edge_data, bezier_args=None):
         if self.curved_lines:
             if bezier_args is None:
                 bezier_args = {}
             lines = curved_edges(edge_data, **bezier_args)
         else:
-            lines = []
-            for edge in edge_data:
-                lines.append(edge.points)
-
-            lines = np.array(lines)
+            lines = _stack_points([edge.points for edge in edge_data])
 
         return lines
 
@@ -97,6 +210,8 @@ class PlainEdges(EdgeStrategy):
         linewidth=1.0,
         linestyle="solid",
         alpha=0.75,
+        rasterized=None,
+        update=False,
         **kwargs,
     ):
         """
@@ -114,6 +229,12 @@ class PlainEdges(EdgeStrategy):
             El estilo de línea de las aristas.
         alpha : float, default=0.75, optional
             La transparencia de las aristas.
+        rasterized : bool, default=None, optional
+            Indica si las aristas se rasterizan al exportar la figura. Si es None, se rasterizan cuando la red
+            tiene más de 5000 aristas.
+        update : bool, default=False, optional
+            Si es True y la estrategia ya dibujó sus aristas en `ax`, reemplaza esa colección por la nueva en vez de
+            agregar otra (p.ej., para redibujar en animaciones). Todas las propiedades se toman de esta llamada.
         **kwargs : dict
             Argumentos adicionales que permiten personalizar la visualización. Una lista completa
             de las opciones disponibles se encuentra en la documentación de la librería `Matplotlib <https://matplotlib.org/stable/api/collections_api.html#matplotlib.collections.LineCollection>`__.
@@ -124,15 +245,17 @@ class PlainEdges(EdgeStrategy):
             Una colección de líneas que representa las aristas en el gráfico.
 
         """
-        collection = LineCollection(
+        return self._draw_lines(
+            ax,
             self.lines,
             color=color,
             linewidths=linewidth,
             linestyle=linestyle,
             alpha=alpha,
+            rasterized=self._rasterize(rasterized, len(self.lines)),
+            update=update,
             **kwargs,
         )
-        return ax.add_collection(collection)
 
     def name(self):
         return "plain"
@@ -153,8 +276,9 @@ class WeightedEdges(EdgeStrategy):
         Los límites de los bins para los pesos categorizados.
     weights : np.array o None
         Los pesos de las aristas a utilizar para el renderizado.
-    lines : np.array o None
-        Las coordenadas de las aristas a renderizar.
+    lines : np.array, list o None
+        Las coordenadas de las aristas a renderizar. Si las aristas tienen distinta cantidad de puntos,
+        es una lista de arreglos.
 
     """
 
@@ -194,6 +318,7 @@ class WeightedEdges(EdgeStrategy):
         self.bins = None
         self.weights = weights
         self.lines = None
+        self._palette_cache = {}
         self.scheme = scheme
         if not self.scheme in ("bins", "quantiles", "custom"):
             raise ValueError("scheme must be bins, quantiles or custom")
@@ -235,16 +360,12 @@ class WeightedEdges(EdgeStrategy):
 
             weights = np.array(self.network.network.edge_properties[weights].a)
 
-        if weights is not None and not type(weights) in (np.array, np.ndarray):
+        if weights is not None and not isinstance(weights, np.ndarray):
             raise ValueError(f"weights must be np.array instead of {type(weights)}.")
 
         # weights: np.array = weights
-        print(self.scheme)
-
         if self.scheme == "bins":
-            groups, bins = pd.cut(
-                weights, self.k, labels=False, retbins=True, duplicates="raise"
-            )
+            groups, bins = _equal_width_bins(weights, self.k)
             self.bins = bins
         elif self.scheme == "quantiles":
             groups, bins = pd.qcut(
@@ -257,8 +378,11 @@ class WeightedEdges(EdgeStrategy):
             )
         self.line_groups = groups
 
-        print(self.lines.shape, weights.shape)
-        print(self.line_groups)
+        # ordenamos las aristas por grupo una sola vez, de modo que cada grupo sea un rango contiguo
+        order = np.argsort(groups, kind="stable")
+        self._order = order
+        self._lines_sorted = _take_lines(self.lines, order)
+        self._offsets = np.searchsorted(groups[order], np.arange(self.k + 1))
 
     def render(self, ax, *args, **kwargs):
         """
@@ -272,6 +396,12 @@ class WeightedEdges(EdgeStrategy):
             Nombre de la paleta de colores a usar.
         color: str
             Color a partir del cual crear la paleta de colores.
+        rasterized : bool, default=None, optional
+            Indica si las aristas se rasterizan al exportar la figura. Si es None, se rasterizan cuando la red
+            tiene más de 5000 aristas.
+        update : bool, default=False, optional
+            Si es True y la estrategia ya dibujó sus aristas en `ax`, reemplaza esa colección por la nueva en vez de
+            agregar otra (p.ej., para redibujar en animaciones). Todas las propiedades se toman de esta llamada.
         **kwargs : optional
             Argumentos adicionales que permiten personalizar la visualización. Una lista completa
             de las opciones disponibles se encuentra en la documentación de la librería `Matplotlib <https://matplotlib.org/stable/api/collections_api.html#matplotlib.collections.LineCollection>`__.
@@ -279,7 +409,7 @@ class WeightedEdges(EdgeStrategy):
         Returns
         -------
         list
-            Una lista de objetos LineCollection que representan las aristas renderizadas para cada grupo.
+            Una lista con el objeto LineCollection que contiene las aristas renderizadas de todos los grupos.
         """
 
         if "color" in kwargs:
@@ -287,25 +417,53 @@ class WeightedEdges(EdgeStrategy):
         else:
             palette = kwargs.pop("palette", "#a7a7a7")
 
+        edge_colors = self._group_colors(
+            palette, kwargs.pop("palette_type", "dark")
+        )
+
+        # todas las aristas van en una única colección, con un color por arista según su grupo
+        group_sizes = np.diff(self._offsets)
+        colors_rgba = np.repeat(edge_colors, group_sizes, axis=0)
+
+        coll = self._draw_lines(
+            ax,
+            self._lines_sorted[: self._offsets[-1]],
+            colors=colors_rgba,
+            rasterized=self._rasterize(
+                kwargs.pop("rasterized", None), len(self.lines)
+            ),
+            update=kwargs.pop("update", False),
+            **kwargs,
+        )
+
+        return [coll]
+
+    def _group_colors(self, palette, palette_type):
+        """
+        Retorna un arreglo RGBA de forma `(k, 4)` con el color de cada grupo. La paleta solo depende
+        de `palette`, `palette_type` y de los límites de los grupos, por lo que se calcula una vez
+        y se reutiliza en las siguientes llamadas a `render`.
+        """
+        key = (palette, palette_type, tuple(np.asarray(self.bins).tolist()))
+        try:
+            return self._palette_cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # la paleta no es hashable (p.ej., una lista de colores), no se almacena
+            key = None
+
         edge_colors = build_palette(
             self.bins,
             palette=palette,
-            palette_type=kwargs.pop("palette_type", "dark"),
+            palette_type=palette_type,
         )
+        edge_colors = colors.to_rgba_array(edge_colors[: self.k])
 
-        results = []
-        for i in range(self.k):
-            coll_lines = self.lines[self.line_groups == i]
-            print(len(self.lines), len(self.line_groups), len(coll_lines))
+        if key is not None:
+            self._palette_cache[key] = edge_colors
 
-            coll = LineCollection(
-                coll_lines,
-                color=edge_colors[i],
-                **kwargs,
-            )
-            results.append(ax.add_collection(coll))
-
-        return results
+        return edge_colors
 
     def name(self):
         return "weighted"
@@ -328,7 +486,7 @@ class CommunityGradient(EdgeStrategy):
     network : Network
         Objeto Network que representa la red.
     node_communities : np.array
-        Un array numpy que indica a qué comunidad pertenece cada nodo.
+        Un array numpy contiguo (`np.int32`) que indica a qué comunidad pertenece cada nodo.
     community_ids : list
         Una lista de identificadores únicos de las comunidades.
     community_links : defaultdict
@@ -349,23 +507,76 @@ class CommunityGradient(EdgeStrategy):
             Argumentos adicionales (sin uso).
         """
         super().__init__(network)
-        self.node_communities = node_communities
-        self.community_ids = sorted(unique(node_communities))
+        self.node_communities = np.ascontiguousarray(node_communities, dtype=np.int32)
+        community_ids, community_codes = np.unique(
+            self.node_communities, return_inverse=True
+        )
+        self.community_ids = community_ids.tolist()
+        # posición de la comunidad de cada nodo dentro de community_ids
+        self._community_codes = np.ascontiguousarray(community_codes, dtype=np.int32)
         self.community_links = defaultdict(ColoredCurveCollection)
+        self._palette_cache = {}
+
+    def _community_colors(self, palette):
+        """
+        Retorna un diccionario que asocia cada comunidad a su color en la paleta `palette`. La paleta solo depende
+        de `palette` y de `community_ids`, por lo que se calcula la primera vez que se usa y se reutiliza en las
+        siguientes llamadas a `render`.
+        """
+        try:
+            return self._palette_cache[palette]
+        except KeyError:
+            key = palette
+        except TypeError:
+            # la paleta no es hashable (p.ej., una lista de colores), no se almacena
+            key = None
+
+        community_colors = dict(
+            zip(
+                self.community_ids,
+                sns.color_palette(palette, n_colors=len(self.community_ids)),
+            )
+        )
+
+        if key is not None:
+            self._palette_cache[key] = community_colors
+
+        return community_colors
 
     def prepare_data(self):
         """
         Prepara los datos para renderizar las aristas, identificando la comunidad de cada nodo participante de la arista. Almacena
         las líneas a trazar en el atributo `community_links`.
         """
-        for edge_data in self.data:
+        n_edges = len(self.data)
+        n_communities = len(self.community_ids)
+
+        index_pairs = np.array(
+            [e.index_pair for e in self.data], dtype=np.int64
+        ).reshape(-1, 2)
+        src = np.ascontiguousarray(index_pairs[:, 0])
+        tgt = np.ascontiguousarray(index_pairs[:, 1])
+        pair_ids = _community_pair_kernel(
+            src, tgt, self._community_codes, n_communities
+        )
+
+        # agrupamos las aristas por par de comunidades: cada par queda como un rango contiguo de `lines`
+        order = np.argsort(pair_ids, kind="stable")
+        unique_pairs, offsets = np.unique(pair_ids[order], return_index=True)
+        offsets = np.append(offsets, n_edges)
+        lines = _take_lines(_stack_points([e.points for e in self.data]), order)
+
+        self.community_links = defaultdict(ColoredCurveCollection)
+        for i, pair_id in enumerate(unique_pairs):
             pair = (
-                self.node_communities[int(edge_data.index_pair[0])],
-                self.node_communities[int(edge_data.index_pair[1])],
+                self.community_ids[pair_id // n_communities],
+                self.community_ids[pair_id % n_communities],
             )
 
             # TODO: add weight
-            self.community_links[pair].add_curve(edge_data.points, 1)
+            self.community_links[pair] = ColoredCurveCollection.from_curves(
+                lines[offsets[i] : offsets[i + 1]], 1
+            )
 
     def render(self, ax, *args, **kwargs):
         """
@@ -380,17 +591,17 @@ class CommunityGradient(EdgeStrategy):
             de `Matplotlib <https://matplotlib.org/stable/api/collections_api.html#matplotlib.collections.LineCollection>`__.
         palette : string, default="plasma", optional
             Paleta de colores a usar en el trazado de las aristas.
+        rasterized : bool, default=None, optional
+            Indica si las aristas se rasterizan al exportar la figura. Si es None, se rasterizan cuando la red
+            tiene más de 5000 aristas.
         **kwargs : optional
             Argumentos adicionales para configurar la visualización. Una lista completa se encuentra en la documentación
             de `Matplotlib <https://matplotlib.org/stable/api/collections_api.html#matplotlib.collections.LineCollection>`__.
         """
-        community_colors = dict(
-            zip(
-                self.community_ids,
-                sns.color_palette(
-                    kwargs.pop("palette", "plasma"), n_colors=len(self.community_ids)
-                ),
-            )
+        community_colors = self._community_colors(kwargs.pop("palette", "plasma"))
+
+        kwargs["rasterized"] = self._rasterize(
+            kwargs.pop("rasterized", None), len(self.data)
         )
 
         for pair, colored_lines in self.community_links.items():
@@ -442,26 +653,36 @@ class ODGradient(EdgeStrategy):
         """
         interp = np.linspace(0, 1, num=self.n_points, endpoint=True)
 
-        for edge_data in self.data:
-            if type(edge_data.points) == list and len(edge_data.points) == 2:
-                points = np.array(
-                    [
-                        (edge_data.source * (1 - t) + edge_data.target * t)
-                        for t in interp
-                    ]
-                )
-            elif type(edge_data.points) == np.array and edge_data.points.shape[0] == 2:
-                points = np.array(
-                    [
-                        (edge_data.source * (1 - t) + edge_data.target * t)
-                        for t in interp
-                    ]
-                )
-            else:
-                points = edge_data.points
+        edge_points = _stack_points([e.points for e in self.data])
+
+        # separamos las aristas rectas (se interpolan) de las curvas (se usan tal como están)
+        if isinstance(edge_points, np.ndarray):
+            # todas las aristas tienen la misma cantidad de puntos
+            is_straight = np.full(len(edge_points), edge_points.shape[1] == 2)
+        else:
+            is_straight = np.fromiter(
+                (_is_straight_edge(points) for points in edge_points),
+                dtype=bool,
+                count=len(edge_points),
+            )
+        straight_idx = np.flatnonzero(is_straight)
+        curved_idx = np.flatnonzero(~is_straight)
 
+        for i in curved_idx:
             # TODO: add weight
-            self.colored_curves.add_curve(points, 1)
+            self.colored_curves.add_curve(edge_points[i], 1)
+
+        if len(straight_idx) == 0:
+            return
+
+        # interpolamos todas las aristas rectas a la vez: (n_aristas, n_points, 2)
+        src = np.array([self.data[i].source for i in straight_idx], dtype=float)
+        tgt = np.array([self.data[i].target for i in straight_idx], dtype=float)
+        straight_points = np.empty((len(straight_idx), self.n_points, 2))
+        _od_interp_kernel(src, tgt, interp, straight_points)
+
+        # TODO: add weight
+        self.colored_curves.add_curves(straight_points, 1)
 
     def render(self, ax, *args, **kwargs):
         """
@@ -478,6 +699,9 @@ class ODGradient(EdgeStrategy):
             Color que se usará para el extremo "origen" de la arista.
         target_color : string, default="red", optional
             Color que se usará para el extremo "destino" de la arista.
+        rasterized : bool, default=None, optional
+            Indica si las aristas se rasterizan al exportar la figura. Si es None, se rasterizan cuando la red
+            tiene más de 5000 aristas.
         **kwargs : optional
             Argumentos adicionales para configurar la visualización. Una lista completa se encuentra en la documentación
             de `Matplotlib <https://matplotlib.org/stable/api/collections_api.html#matplotlib.collections.LineCollection>`__.
@@ -487,6 +711,9 @@ class ODGradient(EdgeStrategy):
             source=kwargs.pop("source_color", "blue"),
             target=kwargs.pop("target_color", "red"),
         )
+        kwargs["rasterized"] = self._rasterize(
+            kwargs.pop("rasterized", None), len(self.data)
+        )
         self.colored_curves.render(ax, *args, **kwargs)
 
     def name(self):